@@ -9,9 +9,16 @@ setup(
         "selenium>=4.0.0",
         "webdriver-manager>=3.8.0",
         "aiohttp>=3.8.0",
+        "aiofiles>=23.1.0",
         "openai>=1.0.0",
         "beautifulsoup4>=4.9.0",
-        "python-dotenv>=0.19.0"
+        "lxml>=4.9.0",
+        "selectolax>=0.3.17",
+        "python-dotenv>=0.19.0",
+        "xxhash>=3.0.0",
+        "diskcache>=5.6.0",
+        "tiktoken>=0.5.0",
+        "httpx[http2]>=0.24.0"
     ],
     python_requires=">=3.8",
 ) 
\ No newline at end of file
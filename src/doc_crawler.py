@@ -1,29 +1,146 @@
 import os
+import re
+import shutil
 import logging
 import asyncio
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from urllib.parse import urljoin, urlparse
-from typing import Set, Dict
+from typing import Dict, Optional, Set
+import aiofiles
+import aiohttp
+import xxhash
+from lxml import html as lxml_html
+from selectolax.lexbor import LexborHTMLParser
 from gpt_helper import GPTHelper
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
 from webdriver_manager.chrome import ChromeDriverManager
-import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+# Common content containers, tried in order
+CONTENT_SELECTORS = [
+    "main",  # Common main content wrapper
+    ".theme-doc-markdown",  # Docusaurus
+    ".api-content",  # Common API doc class
+    "#content",  # Common content ID
+    "article"  # Common content wrapper
+]
+
+# Pages with less extracted text than this are assumed to need JS rendering
+MIN_STATIC_CONTENT_LENGTH = 200
+
+
+# Block-level elements whose texts become paragraph-separated blocks;
+# nested occurrences (a p inside a blockquote) are covered by the
+# outermost match
+_BLOCK_TAGS = frozenset((
+    'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'li', 'pre', 'blockquote', 'table', 'dt', 'dd'
+))
+_BLOCK_SELECTOR = ','.join(sorted(_BLOCK_TAGS))
+
+
+def _node_text(node) -> str:
+    """Flatten a container node to text with blank-line block boundaries.
+
+    A flat node.text() joins every text node with a single newline, which
+    erases paragraph boundaries - downstream chunking splits on blank
+    lines, so the whole page would collapse into one block. Join each
+    top-level block element's text with \n\n instead, the way innerText
+    renders block elements.
+    """
+    parts = []
+    for element in node.css(_BLOCK_SELECTOR):
+        parent = element.parent
+        nested = False
+        while parent is not None:
+            if parent.tag in _BLOCK_TAGS:
+                nested = True
+                break
+            parent = parent.parent
+        if nested:
+            continue
+        text = element.text(separator="\n", strip=True)
+        if text:
+            parts.append(text)
+
+    if parts:
+        return '\n\n'.join(parts)
+    # Markup without block elements - fall back to the flat dump
+    return node.text(separator="\n", strip=True)
+
+
+def _extract_text(html: str, selectors=tuple(CONTENT_SELECTORS)) -> str:
+    """Pull main-content text out of raw HTML with selectolax.
+
+    Lexbor parses and extracts text in C, so this runs in milliseconds
+    even for large pages, versus pure-Python tree walks.
+    """
+    tree = LexborHTMLParser(html)
+    for selector in selectors:
+        node = tree.css_first(selector)
+        if node:
+            text = _node_text(node)
+            if text:
+                logger.info(f"Found content using selector: {selector}")
+                return text
+
+    # No recognised container - fall back to the whole body text
+    if tree.body:
+        return _node_text(tree.body)
+    return ""
+
+
+_driver_path: Optional[str] = None
+
+
+def _chromedriver_path() -> str:
+    """Resolve the chromedriver binary once per process.
+
+    ChromeDriverManager().install() stat-checks its cache (and may hit
+    the network) on every call; with a pool of drivers that would run
+    once per driver per crawler.
+    """
+    global _driver_path
+    if _driver_path is None:
+        _driver_path = ChromeDriverManager().install()
+    return _driver_path
+
 
 class DocCrawler:
+    """Generic documentation crawler.
+
+    Site-specific crawlers subclass this and override the class-level
+    extension points below (and is_relevant_url/extract_content when a
+    site needs more than different selectors or skip patterns).
+    """
+
+    # Content containers tried in order when extracting page text
+    CONTENT_SELECTORS = tuple(CONTENT_SELECTORS)
+
+    # Non-documentation paths and binary assets, compiled once; checked
+    # for every anchor on every crawled page
+    SKIP_RE = re.compile(
+        r'/(login|signin|signup|register|contact|about|pricing|blog)(/|$)'
+        r'|\.(png|jpe?g|gif|pdf|zip)$',
+        re.IGNORECASE
+    )
+
     def __init__(
         self,
         base_url: str,
         output_dir: str = "coinbase_docs",
         max_pages: int = 50,
-        max_concurrent_pages: int = 3
+        max_concurrent_pages: int = 3,
+        gpt_helper: Optional[GPTHelper] = None
     ):
         self.base_url = base_url
         self.base_domain = urlparse(base_url).netloc
@@ -32,10 +149,52 @@ class DocCrawler:
         self.max_concurrent_pages = max_concurrent_pages
         self.visited_urls: Set[str] = set()
         self.processed_content: Dict[str, str] = {}
-        self.gpt_helper = GPTHelper()
-        self._page_semaphore = asyncio.Semaphore(max_concurrent_pages)
+        # One helper for the whole crawl so every page shares the same
+        # connection pool, rate budget and response cache
+        self.gpt_helper = gpt_helper or GPTHelper()
+        self._http: Optional[aiohttp.ClientSession] = None
+        self._selenium_pool = ThreadPoolExecutor(max_workers=max_concurrent_pages)
+        # Raw HTML kept per URL so link extraction can reuse it without
+        # another fetch, regardless of which path fetched the page
+        self._static_html: Dict[str, str] = {}
+        # Hashes of extracted text, so aliased URLs serving identical
+        # content never reach GPT twice
+        self._content_hashes: Set[int] = set()
+        # Every URL ever enqueued; dedupe happens at enqueue time so the
+        # frontier queue never holds the same URL twice
+        self._seen_urls: Set[str] = set()
+
+        # Initialize a pool of Selenium drivers; the pool size bounds how
+        # many pages can render concurrently, so no extra semaphore needed
+        self._drivers = [self._make_driver() for _ in range(max_concurrent_pages)]
+        self._driver_pool: asyncio.Queue = asyncio.Queue()
+        for driver in self._drivers:
+            self._driver_pool.put_nowait(driver)
+
+        os.makedirs(output_dir, exist_ok=True)
+        # Create the per-page output directories once instead of on
+        # every save
+        self.raw_dir = os.path.join(output_dir, 'raw')
+        self.formatted_dir = os.path.join(output_dir, 'formatted')
+        os.makedirs(self.raw_dir, exist_ok=True)
+        os.makedirs(self.formatted_dir, exist_ok=True)
+
+        # Sections are appended to a partial file as pages finish; the
+        # final document (TOC + sections) is materialized once at the end
+        # of the crawl instead of rewriting everything per batch
+        self._toc_entries = []
+        self._partial_path = os.path.join(output_dir, "api_documentation.partial.md")
+        self._out_fp = open(self._partial_path, 'w', encoding='utf-8')
+
+        # Add progress tracking
+        self.total_processed = 0
+        logger.info(f"Initializing crawler for {base_url}")
+        logger.info(f"Output directory: {output_dir}")
+        logger.info(f"Maximum pages to crawl: {max_pages}")
+        logger.info(f"Maximum concurrent pages: {max_concurrent_pages}")
 
-        # Initialize Selenium
+    def _make_driver(self) -> webdriver.Chrome:
+        """Create a headless Chrome instance for the driver pool."""
         chrome_options = Options()
         chrome_options.add_argument("--headless")
         chrome_options.add_argument("--no-sandbox")
@@ -47,110 +206,217 @@ class DocCrawler:
         chrome_options.add_argument("--disable-web-security")  # Be careful with this in production
         chrome_options.add_argument("--allow-running-insecure-content")
         chrome_options.add_argument("--disable-blink-features=AutomationControlled")
-        chrome_options.add_argument("--user-agent=Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
-
-        self.driver = webdriver.Chrome(
-            service=Service(ChromeDriverManager().install()),
+        chrome_options.add_argument(f"--user-agent={USER_AGENT}")
+
+        # We only consume text, so return at DOMContentLoaded and skip
+        # downloading images and stylesheets entirely
+        chrome_options.page_load_strategy = "eager"
+        chrome_options.add_experimental_option("prefs", {
+            "profile.managed_default_content_settings.images": 2,
+            "permissions.default.stylesheet": 2
+        })
+
+        driver = webdriver.Chrome(
+            service=Service(_chromedriver_path()),
             options=chrome_options
         )
 
+        # Block heavy asset types and third-party analytics/trackers at
+        # the network layer; doc sites ship plenty of both and none of it
+        # contributes to the extracted text
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {
+            "urls": [
+                "*.png", "*.jpg", "*.jpeg", "*.gif", "*.woff*", "*.mp4",
+                "*google-analytics*", "*googletagmanager*", "*segment.io*",
+                "*hotjar*", "*intercom*", "*doubleclick*", "*facebook.net*"
+            ]
+        })
+        driver.execute_cdp_cmd("Network.enable", {})
+
         # Set page load timeout
-        self.driver.set_page_load_timeout(90)
+        driver.set_page_load_timeout(90)
+        return driver
 
-        os.makedirs(output_dir, exist_ok=True)
+    @asynccontextmanager
+    async def _acquire_driver(self):
+        """Check a driver out of the pool for the duration of the block."""
+        driver = await self._driver_pool.get()
+        try:
+            yield driver
+        finally:
+            self._driver_pool.put_nowait(driver)
 
-        # Add progress tracking
-        self.total_processed = 0
-        logger.info(f"Initializing crawler for {base_url}")
-        logger.info(f"Output directory: {output_dir}")
-        logger.info(f"Maximum pages to crawl: {max_pages}")
-        logger.info(f"Maximum concurrent pages: {max_concurrent_pages}")
+    async def __aenter__(self):
+        return self
 
-    def __del__(self):
-        """Clean up Selenium driver"""
-        if hasattr(self, 'driver'):
-            self.driver.quit()
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """Release the HTTP session, Selenium drivers and worker threads."""
+        if self._http is not None and not self._http.closed:
+            await self._http.close()
+        for driver in self._drivers:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+        self._drivers = []
+        self._selenium_pool.shutdown(wait=False)
+        if not self._out_fp.closed:
+            self._out_fp.close()
+        await self.gpt_helper.aclose()
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _url_parts(url: str):
+        """Derive (section name, anchor, filename stem) from a URL once.
+
+        The same URL is munged in the per-page save, the section append
+        and the final write; cache so each URL pays the string work once.
+        """
+        last = url.rstrip('/').rsplit('/', 1)[-1] or 'index'
+        return last.replace('-', ' ').title(), last.lower(), last.replace('-', '_')
+
+    @staticmethod
+    def _canonicalize_url(url: str) -> str:
+        """Normalize a URL so aliases collapse to one frontier entry."""
+        url, _, _ = url.partition('#')
+        if urlparse(url).path not in ('', '/'):
+            url = url.rstrip('/')
+        return url
 
     def is_relevant_url(self, url: str) -> bool:
         """Check if URL is relevant to the API documentation."""
+        return self._check_relevance(url, self.base_domain, self.SKIP_RE)
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _check_relevance(url: str, base_domain: str, skip_re) -> bool:
+        """Cached relevance check; same URLs recur across crawled pages."""
         parsed = urlparse(url)
 
         # Must be same domain
-        if parsed.netloc != self.base_domain:
+        if parsed.netloc != base_domain:
             return False
 
         # Must be in the docs section
-        if '/docs/' not in url:
+        if '/docs/' not in parsed.path:
             return False
 
-        # Skip non-documentation paths
-        skip_patterns = [
-            '/login', '/signin', '/signup', '/register',
-            '/contact', '/about', '/pricing', '/blog',
-            '.png', '.jpg', '.jpeg', '.gif', '.pdf', '.zip'
-        ]
-        return not any(pattern in url.lower() for pattern in skip_patterns)
+        # Skip non-documentation paths and binary assets
+        return not skip_re.search(url)
+
+    async def _ensure_session(self) -> aiohttp.ClientSession:
+        """Lazily create the shared HTTP session for static page fetches."""
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=32, limit_per_host=16, keepalive_timeout=30, ssl=False),
+                headers={"User-Agent": USER_AGENT}
+            )
+        return self._http
+
+    async def _fetch_static(self, url: str) -> str:
+        """Fetch a page over plain HTTP and extract text without a browser."""
+        session = await self._ensure_session()
+        async with session.get(url) as response:
+            response.raise_for_status()
+            body = await response.text()
+
+        content = _extract_text(body, self.CONTENT_SELECTORS)
+        if content:
+            self._static_html[url] = body
+        return content
+
+    async def extract_content(self, url: str) -> str:
+        """Extract relevant content, preferring a plain HTTP fetch.
+
+        Most documentation pages are statically rendered, so try a plain
+        aiohttp fetch first and only fall back to Selenium when the static
+        fetch yields little or no text (i.e. the page needs JS rendering).
+        """
+        try:
+            content = await self._fetch_static(url)
+            if len(content) >= MIN_STATIC_CONTENT_LENGTH:
+                logger.info(f"Static fetch succeeded for: {url}")
+                return content
+            logger.info(f"Static fetch too thin ({len(content)} chars), falling back to Selenium: {url}")
+        except Exception as e:
+            logger.info(f"Static fetch failed ({str(e)}), falling back to Selenium: {url}")
+
+        loop = asyncio.get_event_loop()
+        async with self._acquire_driver() as driver:
+            return await loop.run_in_executor(self._selenium_pool, self._selenium_extract, driver, url)
+
+    def _wait_for_dom_quiescence(self, driver: webdriver.Chrome, settle_ms: int = 500, ceiling_s: int = 8):
+        """Block until the DOM has been mutation-free for settle_ms.
 
-    def extract_content(self, url: str) -> str:
+        A MutationObserver resolves the async script once no subtree
+        changes have happened for the settle window, with a hard ceiling
+        enforced by the script timeout so a chatty page can't stall us.
+        """
+        try:
+            driver.set_script_timeout(ceiling_s)
+            driver.execute_async_script(
+                """
+                const cb = arguments[arguments.length - 1];
+                const settle = arguments[0];
+                let t = setTimeout(cb, settle);
+                new MutationObserver(() => {
+                    clearTimeout(t);
+                    t = setTimeout(cb, settle);
+                }).observe(document.body, {subtree: true, childList: true, attributes: true});
+                """,
+                settle_ms
+            )
+        except Exception as e:
+            # Page never went quiet within the ceiling - proceed with
+            # whatever has rendered so far
+            logger.debug(f"DOM quiescence wait timed out: {str(e)}")
+
+    @staticmethod
+    def _navigate(driver: webdriver.Chrome, url: str):
+        """Navigate a pooled driver, reusing the warm renderer when possible.
+
+        driver.get tears down the renderer for cross-origin navigation;
+        for same-origin hops a location.replace keeps Chrome's JS and
+        connection caches warm. Each driver remembers its current origin.
+        """
+        origin = urlparse(url).netloc
+        if getattr(driver, '_current_origin', None) == origin:
+            try:
+                driver.execute_script("window.location.replace(arguments[0]);", url)
+                # Script navigation returns before the new document
+                # commits; wait until the browser is actually on the
+                # target URL so extraction can't read the previous page
+                WebDriverWait(driver, 10).until(
+                    lambda d: d.current_url.rstrip('/') == url.rstrip('/'))
+                return
+            except Exception as e:
+                logger.debug(f"location.replace failed, using driver.get: {str(e)}")
+        driver.get(url)
+        driver._current_origin = origin
+
+    def _selenium_extract(self, driver: webdriver.Chrome, url: str) -> str:
         """Extract relevant content from the page using Selenium."""
         try:
             logger.info(f"Loading page with Selenium: {url}")
-            self.driver.get(url)
-
-            # Wait longer for modern web apps to load (90 seconds)
-            wait = WebDriverWait(self.driver, 90)
-
-            # First wait for any of these common content containers
-            content_selectors = [
-                "main",  # Common main content wrapper
-                ".theme-doc-markdown",  # Docusaurus
-                ".api-content",  # Common API doc class
-                "#content",  # Common content ID
-                "article"  # Common content wrapper
-            ]
-
-            # Wait for the initial content container
-            for selector in content_selectors:
-                try:
-                    wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, selector)))
-                    main_content = self.driver.find_element(By.CSS_SELECTOR, selector)
-                    if main_content:
-                        # Wait for dynamic content to load
-                        logger.info("Waiting for dynamic content to load...")
-                        time.sleep(5)  # Give time for dynamic content
-                        
-                        # Scroll to load all content
-                        logger.info("Scrolling to load all content...")
-                        last_height = self.driver.execute_script("return document.body.scrollHeight")
-                        while True:
-                            # Scroll down
-                            self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-                            time.sleep(2)  # Wait for content to load
-                            
-                            # Calculate new scroll height
-                            new_height = self.driver.execute_script("return document.body.scrollHeight")
-                            if new_height == last_height:
-                                break
-                            last_height = new_height
-                        
-                        # Get the content after everything is loaded
-                        main_content = self.driver.find_element(By.CSS_SELECTOR, selector)
-                        content = main_content.text.strip()
-                        if content:
-                            logger.info(f"Found content using selector: {selector}")
-                            return content
-                except Exception as e:
-                    logger.debug(f"Selector {selector} not found: {str(e)}")
-                    continue
-
-            # If no content found with specific selectors, try getting body content
-            logger.info("No specific content container found, trying body...")
-            body = self.driver.find_element(By.TAG_NAME, "body")
-            if body:
-                content = body.text.strip()
-                if content:
-                    logger.info("Retrieved content from body")
-                    return content
+            self._navigate(driver, url)
+
+            # Trigger any lazy-loaded content, then wait for the DOM to
+            # go quiet instead of sleeping blindly
+            logger.info("Waiting for dynamic content to settle...")
+            driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+            self._wait_for_dom_quiescence(driver)
+
+            # One page_source round-trip; text extraction happens
+            # in-process instead of through per-element CDP calls
+            html = driver.page_source
+            content = _extract_text(html, self.CONTENT_SELECTORS)
+            if content:
+                self._static_html[url] = html
+                return content
 
             logger.warning("No content containers found")
             return ""
@@ -159,182 +425,225 @@ class DocCrawler:
             logger.error(f"Error extracting content: {str(e)}")
             logger.error("Attempting to get page source as fallback...")
             try:
-                return self.driver.page_source
+                return driver.page_source
             except:
                 return ""
 
-    def get_page_links(self) -> Set[str]:
-        """Get all links from the current page."""
+    def get_page_links(self, url: str) -> Set[str]:
+        """Get all links from the given page."""
         links = set()
         try:
-            elements = self.driver.find_elements(By.TAG_NAME, "a")
-            for element in elements:
-                href = element.get_attribute('href')
+            # Both fetch paths stash the page HTML, so links never need a
+            # driver round-trip (the driver is back in the pool by now).
+            # lxml xpath pulls every href in one in-process pass.
+            html = self._static_html.pop(url, None)
+            if html is None:
+                return links
+            doc = lxml_html.fromstring(html)
+            hrefs = doc.xpath('//a/@href')
+
+            for href in hrefs:
                 if href:
-                    full_url = urljoin(self.base_url, href)
+                    full_url = self._canonicalize_url(urljoin(self.base_url, href))
                     if self.is_relevant_url(full_url) and full_url not in self.visited_urls:
                         links.add(full_url)
         except Exception as e:
             logger.error(f"Error getting links: {str(e)}")
         return links
 
-    def save_page_content(self, url: str, content: str, formatted_content: str):
+    async def save_page_content(self, url: str, content: str, formatted_content: str):
         """Save both raw and formatted content for a single page."""
-        # Create a valid filename from the URL
-        filename = url.split('/')[-1].replace('-', '_')
-        if not filename:
-            filename = 'index'
-        
+        section_name, _, filename = self._url_parts(url)
+
         # Save raw content
-        raw_dir = os.path.join(self.output_dir, 'raw')
-        os.makedirs(raw_dir, exist_ok=True)
-        raw_file = os.path.join(raw_dir, f"{filename}_raw.txt")
-        with open(raw_file, 'w', encoding='utf-8') as f:
-            f.write(f"URL: {url}\n\n")
-            f.write(content)
+        raw_file = os.path.join(self.raw_dir, f"{filename}_raw.txt")
+        async with aiofiles.open(raw_file, 'w', encoding='utf-8') as f:
+            await f.write(f"URL: {url}\n\n")
+            await f.write(content)
         logger.info(f"Raw content saved to: {raw_file}")
-        
+
         # Save formatted content
-        formatted_dir = os.path.join(self.output_dir, 'formatted')
-        os.makedirs(formatted_dir, exist_ok=True)
-        formatted_file = os.path.join(formatted_dir, f"{filename}_formatted.md")
-        with open(formatted_file, 'w', encoding='utf-8') as f:
-            f.write(f"# {filename.replace('_', ' ').title()}\n\n")
-            f.write(f"Source: {url}\n\n")
-            f.write(formatted_content)
+        formatted_file = os.path.join(self.formatted_dir, f"{filename}_formatted.md")
+        async with aiofiles.open(formatted_file, 'w', encoding='utf-8') as f:
+            await f.write(f"# {section_name}\n\n")
+            await f.write(f"Source: {url}\n\n")
+            await f.write(formatted_content)
         logger.info(f"Formatted content saved to: {formatted_file}")
 
-    async def process_page(self, url: str) -> None:
+    async def process_page(self, url: str) -> Set[str]:
         """Process a single page asynchronously."""
-        async with self._page_semaphore:
-            try:
-                logger.info(f"\n{'='*50}")
-                logger.info(f"Processing page: {url}")
-                logger.info(f"{'='*50}")
-                
-                content = self.extract_content(url)
-
-                if not content:
-                    logger.warning(f"No content extracted from: {url}")
-                    return set()
+        try:
+            logger.info(f"\n{'='*50}")
+            logger.info(f"Processing page: {url}")
+            logger.info(f"{'='*50}")
+            
+            content = await self.extract_content(url)
+
+            if not content:
+                logger.warning(f"No content extracted from: {url}")
+                return set()
+
+            logger.info(f"Content extracted successfully ({len(content)} characters)")
+
+            # Skip GPT for content we've already processed under another URL
+            content_hash = xxhash.xxh3_64_intdigest(content.encode())
+            if content_hash in self._content_hashes:
+                logger.info(f"Duplicate content, skipping GPT formatting: {url}")
+                return set()
+            self._content_hashes.add(content_hash)
+            
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Split into %d content blocks", content.count('\n\n') + 1)
 
-                logger.info(f"Content extracted successfully ({len(content)} characters)")
-                
-                # Split content into chunks for better visibility
-                chunks = content.split('\n\n')
-                logger.info(f"Split into {len(chunks)} content blocks")
-                
-                # Process content
-                try:
-                    logger.info("Sending to GPT for formatting...")
-                    formatted_content = await self.gpt_helper.format_documentation(content)
-                    if formatted_content:
-                        logger.info(f"Content formatting successful ({len(formatted_content)} characters)")
-                        self.processed_content[url] = formatted_content
-                        
-                        # Save individual page content
-                        self.save_page_content(url, content, formatted_content)
-                        
-                        # Get new URLs to process
-                        logger.info("Extracting links from page...")
-                        new_urls = self.get_page_links()
-                        new_urls = {u for u in new_urls if u not in self.visited_urls}
-                        logger.info(f"Found {len(new_urls)} new URLs to process")
-                        
-                        logger.info(f"{'='*50}\n")
-                        return new_urls
-                    else:
-                        logger.error("GPT formatting returned empty content")
-                        return set()
-                except Exception as e:
-                    logger.error(f"Error during GPT processing: {str(e)}")
+            # Process content
+            try:
+                logger.info("Sending to GPT for formatting...")
+                formatted_content = await self.gpt_helper.format_and_review(content)
+                if formatted_content:
+                    logger.info(f"Content formatting successful ({len(formatted_content)} characters)")
+                    self.processed_content[url] = formatted_content
+                    # Run on the event loop: the writes are small and
+                    # buffered, and staying single-threaded serializes
+                    # concurrent workers so sections can't interleave
+                    # mid-stream in the partial file
+                    self._append_section(url, formatted_content)
+                    
+                    # Save individual page content off the event loop
+                    await self.save_page_content(url, content, formatted_content)
+                    
+                    # Get new URLs to process
+                    logger.info("Extracting links from page...")
+                    new_urls = await asyncio.to_thread(self.get_page_links, url)
+                    new_urls = {u for u in new_urls if u not in self.visited_urls}
+                    logger.info(f"Found {len(new_urls)} new URLs to process")
+                    
+                    logger.info(f"{'='*50}\n")
+                    return new_urls
+                else:
+                    logger.error("GPT formatting returned empty content")
                     return set()
             except Exception as e:
-                logger.error(f"Error processing {url}")
-                logger.error(f"Error details: {str(e)}")
+                logger.error(f"Error during GPT processing: {str(e)}")
                 return set()
+        except Exception as e:
+            logger.error(f"Error processing {url}")
+            logger.error(f"Error details: {str(e)}")
+            return set()
+        finally:
+            # get_page_links pops the stashed HTML on the success path;
+            # duplicate-content and error exits must not leave megabytes
+            # of page source pinned for the rest of the crawl
+            self._static_html.pop(url, None)
+
+    def _append_section(self, url: str, content: str):
+        """Append one formatted section to the partial documentation file."""
+        section_name, anchor, _ = self._url_parts(url)
+        self._toc_entries.append((section_name, anchor))
+
+        self._out_fp.write(f"## {section_name}\n\n")
+        self._out_fp.write(f"Source: {url}\n\n")
+        self._out_fp.write(content)
+        self._out_fp.write("\n\n---\n\n")
+        self._out_fp.flush()
 
     def save_documentation(self):
-        """Save all processed content into a single markdown file."""
+        """Materialize the final markdown file from the TOC and sections."""
         output_file = os.path.join(self.output_dir, "api_documentation.md")
+        self._out_fp.flush()
 
         with open(output_file, 'w', encoding='utf-8') as f:
             f.write("# API Documentation\n\n")
             f.write("## Table of Contents\n\n")
 
             # Write table of contents
-            for url in self.processed_content.keys():
-                section_name = url.split('/')[-1].replace('-', ' ').title()
-                anchor = url.split('/')[-1].lower()
+            for section_name, anchor in self._toc_entries:
                 f.write(f"- [{section_name}](#{anchor})\n")
 
             f.write("\n---\n\n")
 
-            # Write content
-            for url, content in self.processed_content.items():
-                section_name = url.split('/')[-1].replace('-', ' ').title()
-                f.write(f"## {section_name}\n\n")
-                f.write(f"Source: {url}\n\n")
-                f.write(content)
-                f.write("\n\n---\n\n")
+            # Stream the already-written sections across in one copy
+            with open(self._partial_path, 'r', encoding='utf-8') as partial:
+                shutil.copyfileobj(partial, f)
 
         logger.info(f"Documentation saved to: {output_file}")
 
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        """Pull URLs off the frontier queue until the crawl is done."""
+        while True:
+            url = await queue.get()
+            try:
+                if url in self.visited_urls or len(self.visited_urls) >= self.max_pages:
+                    continue
+                self.visited_urls.add(url)
+
+                logger.info(
+                    f"Progress: {len(self.visited_urls)}/{self.max_pages} pages "
+                    f"({(len(self.visited_urls) / self.max_pages) * 100:.1f}%), "
+                    f"{queue.qsize()} URLs queued")
+
+                new_urls = await self.process_page(url)
+                for new_url in new_urls or ():
+                    if new_url not in self._seen_urls:
+                        self._seen_urls.add(new_url)
+                        queue.put_nowait(new_url)
+            finally:
+                queue.task_done()
+
     async def crawl(self) -> None:
         """Crawl the documentation and save as a single markdown file."""
-        urls_to_visit = {self.base_url}
-        tasks = []
+        # FIFO order keeps sibling URLs (shared path prefixes, warm
+        # connections and caches) together in the frontier
+        queue: asyncio.Queue = asyncio.Queue()
+        start_url = self._canonicalize_url(self.base_url)
+        self._seen_urls.add(start_url)
+        queue.put_nowait(start_url)
 
         logger.info("Starting crawl process...")
         logger.info(f"Initial URL queue size: 1")
 
-        while urls_to_visit and len(self.visited_urls) < self.max_pages:
-            remaining_pages = self.max_pages - len(self.visited_urls)
-            queue_size = len(urls_to_visit)
-
-            logger.info(f"\nProgress Update:")
-            logger.info(f"Pages processed: {len(self.visited_urls)}")
-            logger.info(f"Pages remaining: {remaining_pages}")
-            logger.info(f"URLs in queue: {queue_size}")
-            logger.info(
-                f"Completion: {(len(self.visited_urls) / self.max_pages) * 100:.1f}%")
-
-            # Process up to max_concurrent_pages pages in parallel
-            current_batch = []
-            while urls_to_visit and len(current_batch) < self.max_concurrent_pages:
-                url = urls_to_visit.pop()
-                if url not in self.visited_urls:
-                    current_batch.append(url)
-                    self.visited_urls.add(url)
-
-            if current_batch:
-                # Process the batch in parallel
-                batch_tasks = [self.process_page(url) for url in current_batch]
-                new_urls_list = await asyncio.gather(*batch_tasks)
-                
-                # Add new URLs to visit
-                for new_urls in new_urls_list:
-                    urls_to_visit.update(new_urls)
-
-                # Save progress after each batch
-                self.save_documentation()
-
-        # Perform final review of the entire documentation
+        # A fixed pool of workers pulls from the queue continuously, so a
+        # slow page never holds up the rest of a "batch"
+        workers = [
+            asyncio.create_task(self._worker(queue))
+            for _ in range(self.max_concurrent_pages)
+        ]
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        # Sections were formatted and reviewed in one fused pass as they
+        # were processed, so finishing the document only needs the short
+        # stitch call for the intro/TOC
         if self.processed_content:
-            logger.info("\nPerforming final documentation review...")
-            
-            # Read the current documentation file
-            output_file = os.path.join(self.output_dir, "api_documentation.md")
-            with open(output_file, 'r', encoding='utf-8') as f:
-                current_content = f.read()
-            
-            # Perform the final review
-            reviewed_content = await self.gpt_helper.final_review(current_content)
-            
-            # Save the reviewed documentation
-            with open(output_file, 'w', encoding='utf-8') as f:
-                f.write(reviewed_content)
-            
+            logger.info("\nStitching final documentation...")
+
+            section_names = [name for name, _ in self._toc_entries]
+            intro = await self.gpt_helper.stitch(section_names)
+
+            await asyncio.to_thread(self._write_reviewed, intro)
             logger.info("Final documentation review completed!")
+        else:
+            await asyncio.to_thread(self.save_documentation)
 
         logger.info("Crawl completed!")
+
+    def _write_reviewed(self, intro: str):
+        """Write the final document: intro/TOC plus the appended sections."""
+        output_file = os.path.join(self.output_dir, "api_documentation.md")
+        self._out_fp.flush()
+
+        with open(output_file, 'w', encoding='utf-8') as f:
+            f.write("# API Documentation\n\n")
+            if intro:
+                f.write(intro)
+                f.write("\n\n---\n\n")
+
+            # Sections were already serialized once into the partial
+            # file; stream them across in one copy and retire the partial
+            with open(self._partial_path, 'r', encoding='utf-8') as partial:
+                shutil.copyfileobj(partial, f)
+
+        self._out_fp.close()
+        os.unlink(self._partial_path)
+        logger.info(f"Documentation saved to: {output_file}")
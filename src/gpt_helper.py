@@ -1,44 +1,31 @@
+import aiofiles
+import bisect
+import collections
+import diskcache
+import hashlib
+import httpx
+import io
 import openai
 import os
+import random
+import re
+import statistics
+import tiktoken
 import time
 import logging
 import asyncio
 from dotenv import load_dotenv
-from typing import Optional, List
+from typing import AsyncIterator, Final, List, Optional, Tuple
 from time import perf_counter
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-load_dotenv()
 
-
-class GPTHelper:
-    def __init__(self):
-        self.api_key = os.getenv('OPENAI_API_KEY')
-        if not self.api_key:
-            raise ValueError(
-                "OPENAI_API_KEY not found in environment variables")
-        self.client = openai.AsyncOpenAI(api_key=self.api_key)
-        self.max_retries = 3
-        self.chunk_size = 2000
-        self.timeout = 90  # Increased to 90 seconds
-        self.total_api_time = 0
-        self.total_api_calls = 0
-        self.max_concurrent_calls = 2  # Reduced to 2 concurrent calls for better stability
-        self._semaphore = asyncio.Semaphore(self.max_concurrent_calls)
-        logger.info(f"GPTHelper initialized (max {self.max_concurrent_calls} concurrent calls)")
-        
-    async def _call_gpt(self, content: str, retries: int = 0, system_message: str = None) -> Optional[str]:
-        """Make a single GPT API call with retry logic."""
-        async with self._semaphore:
-            try:
-                logger.info(f"Making GPT API call (attempt {retries + 1})")
-                start_time = perf_counter()
-
-                # Use default system message if none provided
-                if system_message is None:
-                    system_message = """You are an expert Apple framework documentation engineer. Format this documentation chunk into clean markdown.
+# System prompts are constant for the life of the process; building them
+# inline on every call churned the allocator for no benefit, and module
+# constants can be token-counted once for cost accounting.
+_DEFAULT_SYSTEM_MSG: Final[str] = """You are an expert Apple framework documentation engineer. Format this documentation chunk into clean markdown.
 Focus on:
 • Framework overview and concepts
 • Types, protocols, and class hierarchies
@@ -66,9 +53,258 @@ Structure sections as:
 5. Parameters/Return Value
 6. See Also/Related"""
 
+# Appended to the batch's base prompt so coalesced documents keep their
+# <<<DOC n>>> markers and can be split apart again
+_BATCH_WRAPPER_MSG: Final[str] = (
+    "\n\nYou will receive multiple independent documents at once, each "
+    "preceded by a <<<DOC n>>> marker line. Apply the instructions above "
+    "to each document separately, and reproduce each <<<DOC n>>> marker "
+    "verbatim before its output. Do not merge, reorder or drop documents."
+)
+
+_FUSED_SYSTEM_MSG: Final[str] = _DEFAULT_SYSTEM_MSG + """
+
+After formatting, also review your output as an expert documentation reviewer:
+• Remove any duplicate content
+• Ensure consistent formatting, style and heading hierarchy
+• Make parameter descriptions clear and keep related material grouped
+
+Return only the final, reviewed markdown."""
+
+_REVIEW_SYSTEM_MSG: Final[str] = """You are an expert technical documentation reviewer. Review and improve this API documentation chunk.
+Focus on:
+1. Removing any duplicate content
+2. Ensuring consistent formatting and style
+3. Making the documentation clear and readable
+4. Proper markdown formatting
+5. Consistent heading hierarchy
+6. Proper section breaks
+7. Complete and accurate endpoint documentation
+8. Consistent use of code blocks and tables
+9. Clear parameter descriptions
+10. Proper grouping of related endpoints
+
+Keep all valid API endpoint information but make it more concise and well-organized."""
+
+_SECTION_REVIEW_SYSTEM_MSG: Final[str] = """You are an expert technical documentation reviewer. Review and improve this documentation section.
+Focus on:
+1. Removing any duplicate content
+2. Ensuring consistent formatting and style
+3. Making the documentation clear and readable
+4. Proper markdown formatting
+5. Consistent heading hierarchy
+6. Clear parameter descriptions
+
+Keep all valid API information but make it more concise and well-organized. Return only the improved section."""
+
+_STITCH_SYSTEM_MSG: Final[str] = """You are an expert technical documentation editor. You will receive the list of section names of an API documentation document.
+Write a brief introduction paragraph followed by a markdown table of contents linking to each section (use lowercase anchors). Return only the markdown."""
+
+_MERGE_SYSTEM_MSG: Final[str] = """You are an expert technical documentation editor. You will receive two adjacent parts of an API documentation document.
+Merge them into one continuous, well-organized document part.
+
+Focus on:
+1. Removing content duplicated between the two parts
+2. Consistent heading levels and formatting across the seam
+3. Keeping all valid API endpoint information
+4. Grouping related endpoints together
+
+Return only the merged markdown."""
+
+_RESET_RE: Final = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+
+
+def _parse_reset(value: Optional[str]) -> float:
+    """Parse OpenAI reset hints like "1.2s", "1s500ms" or "6m0s" into seconds."""
+    if not value:
+        return 0.0
+    units = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+    return sum(float(number) * units[unit] for number, unit in _RESET_RE.findall(value))
+
+
+class GPTHelper:
+    # Shared across every helper instance in the process: even if a
+    # caller constructs one helper per page, they all draw from the same
+    # concurrency permits and request-per-minute budget
+    _shared_semaphore: Optional[asyncio.Semaphore] = None
+    _shared_rate_lock: Optional[asyncio.Lock] = None
+    _rpm = 500
+    _next_slot = 0.0
+
+    def __init__(self):
+        self.model = "gpt-4o"
+        self.max_retries = 3
+        # Total wall-clock budget per chunk across all retries; without
+        # it one chunk could pin a worker for 3 x (90s + backoff)
+        self.call_deadline = 180
+        # The model bills and limits by tokens, so chunks are packed by
+        # actual token count rather than characters; the encoding loads
+        # lazily since tiktoken may fetch the BPE file on first use
+        self._enc_cache: Optional[tiktoken.Encoding] = None
+        self.chunk_tokens = 6000
+        self.review_chunk_tokens = 12000  # final review just cleans up
+        self.timeout = 90  # Increased to 90 seconds
+        # Rolling latency window: a bounded deque keeps p50/p95 honest on
+        # long runs where an all-time mean would hide tail regressions
+        self._durations = collections.deque(maxlen=1024)
+        self._call_count = 0
+        self.max_concurrent_calls = 20
+        # Token-bucket pacing: the semaphore caps in-flight calls, while
+        # the request-per-minute budget spaces out call starts so bursts
+        # don't trip the provider's rate limits
+        if GPTHelper._shared_semaphore is None:
+            GPTHelper._shared_semaphore = asyncio.Semaphore(self.max_concurrent_calls)
+            GPTHelper._shared_rate_lock = asyncio.Lock()
+        self._semaphore = GPTHelper._shared_semaphore
+        self._rate_lock = GPTHelper._shared_rate_lock
+        # Coalesce small documents into one API call; tuned to stay well
+        # under the model context while cutting round-trips
+        self.batch_size = 4
+        self.batch_window = 0.2  # seconds to wait for more documents
+        self.batch_doc_tokens = self.chunk_tokens // self.batch_size
+        self._format_queue: Optional[asyncio.Queue] = None
+        self._batch_worker_task: Optional[asyncio.Task] = None
+        # Content-addressed response cache; crawled docs repeat a lot of
+        # boilerplate and a cache hit skips the network round-trip and
+        # token billing entirely
+        self._cache = diskcache.Cache(".gpt_cache")
+        # Client construction (and .env loading) is deferred to first API
+        # use, so helpers built just for splitting/token counting never
+        # pay for it
+        self._client: Optional[openai.AsyncOpenAI] = None
+        logger.info(f"GPTHelper initialized (max {self.max_concurrent_calls} concurrent calls)")
+        
+    @property
+    def _enc(self) -> tiktoken.Encoding:
+        """The tokenizer, loaded on first use (may hit the network once)."""
+        if self._enc_cache is None:
+            self._enc_cache = tiktoken.encoding_for_model(self.model)
+        return self._enc_cache
+
+    @property
+    def client(self) -> openai.AsyncOpenAI:
+        """The AsyncOpenAI client, constructed on first API use."""
+        if self._client is None:
+            if not os.getenv('OPENAI_API_KEY'):
+                load_dotenv()
+            api_key = os.getenv('OPENAI_API_KEY')
+            if not api_key:
+                raise ValueError(
+                    "OPENAI_API_KEY not found in environment variables")
+            # One HTTP/2 connection pool shared by every in-flight
+            # request; the SDK default pool (10 connections, HTTP/1.1)
+            # would reopen TLS connections constantly at 20-way
+            # concurrency
+            http_client = httpx.AsyncClient(
+                http2=True,
+                timeout=httpx.Timeout(self.timeout, connect=10),
+                limits=httpx.Limits(
+                    max_connections=64,
+                    max_keepalive_connections=64,
+                    keepalive_expiry=60
+                )
+            )
+            self._client = openai.AsyncOpenAI(api_key=api_key, http_client=http_client)
+        return self._client
+
+    async def aclose(self):
+        """Shut down the batch worker and the underlying HTTP client."""
+        if self._batch_worker_task is not None and not self._batch_worker_task.done():
+            self._batch_worker_task.cancel()
+        # Fail any documents still waiting on the batch queue so their
+        # callers don't hang forever on an unresolved future
+        if self._format_queue is not None:
+            while not self._format_queue.empty():
+                _, _, future = self._format_queue.get_nowait()
+                if not future.done():
+                    future.set_exception(RuntimeError("GPTHelper closed before formatting"))
+        if self._client is not None:
+            await self._client.close()
+
+    def _cache_key(self, system_message: str, content: str) -> str:
+        """Content-addressed key covering everything that shapes a response."""
+        payload = f"{self.model}|{system_message}|{content}".encode()
+        return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+    def _record_duration(self, duration: float):
+        """Track call latency; log percentiles every 50 calls.
+
+        Logging per call is measurable overhead at 20-way concurrency and
+        a running mean hides the tail, so summarize periodically instead.
+        """
+        self._durations.append(duration)
+        self._call_count += 1
+        if self._call_count % 50 == 0 and len(self._durations) >= 2:
+            quantiles = statistics.quantiles(self._durations, n=20)
+            logger.info(
+                "GPT latency p50=%.2fs p95=%.2fs over last %d calls (total %d)",
+                quantiles[9], quantiles[18], len(self._durations), self._call_count)
+
+    async def _acquire_rate_slot(self):
+        """Reserve the next request slot, sleeping until it comes up."""
+        loop = asyncio.get_event_loop()
+        async with self._rate_lock:
+            now = loop.time()
+            delay = max(0.0, GPTHelper._next_slot - now)
+            GPTHelper._next_slot = max(now, GPTHelper._next_slot) + 60.0 / GPTHelper._rpm
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    async def _call_gpt(self, content: str, system_message: str = None) -> Optional[str]:
+        """Make a single GPT API call with retry logic and a total deadline."""
+        # Belt-and-braces guard on top of the in-loop deadline checks
+        return await asyncio.wait_for(
+            self._call_gpt_with_retries(content, system_message),
+            timeout=self.call_deadline + 5)
+
+    async def _call_gpt_with_retries(self, content: str, system_message: str = None) -> Optional[str]:
+        """Retry loop for one chunk, bounded by the per-chunk deadline."""
+        # Use default system message if none provided
+        if system_message is None:
+            system_message = _DEFAULT_SYSTEM_MSG
+
+        cache_key = self._cache_key(system_message, content)
+        cached = await asyncio.to_thread(self._cache.get, cache_key)
+        if cached is not None:
+            logger.info("GPT cache hit, skipping API call")
+            return cached
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.call_deadline
+
+        last_error: Optional[Exception] = None
+        for attempt in range(self.max_retries + 1):
+            # The semaphore is held only for the attempt itself and
+            # released before any backoff sleep, so a retrying chunk
+            # never pins a concurrency permit while idle
+            async with self._semaphore:
+                await self._acquire_rate_slot()
+
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    logger.warning(
+                        f"Chunk exhausted its {self.call_deadline}s deadline after {attempt} attempts")
+                    raise TimeoutError(
+                        f"GPT call exceeded {self.call_deadline}s deadline")
+
                 try:
-                    response = await self.client.chat.completions.create(
-                        model="gpt-4o",
+                    logger.info(f"Making GPT API call (attempt {attempt + 1})")
+                    start_time = perf_counter()
+
+                    # Per-attempt timeout shrinks as the deadline nears,
+                    # so retries can't overrun the chunk's budget.
+                    # Streaming lets the receive loop overlap with the
+                    # model still generating; callers get the full text
+                    # once the last delta lands
+                    client = self.client.with_options(timeout=min(self.timeout, remaining))
+                    stream = await client.chat.completions.create(
+                        model=self.model,
                         messages=[
                             {
                                 "role": "system",
@@ -80,158 +316,525 @@ Structure sections as:
                             }
                         ],
                         temperature=0.1,
-                        timeout=self.timeout
+                        stream=True
                     )
-                    
-                    end_time = perf_counter()
-                    duration = end_time - start_time
-                    self.total_api_time += duration
-                    self.total_api_calls += 1
-                    avg_time = self.total_api_time / self.total_api_calls
-                    
-                    logger.info(f"GPT API call successful - Took {duration:.2f}s (Avg: {avg_time:.2f}s)")
-                    return response.choices[0].message.content
-                    
+                    parts = []
+                    async for event in stream:
+                        if not event.choices:
+                            continue
+                        delta = event.choices[0].delta.content
+                        if delta:
+                            parts.append(delta)
+
+                    duration = perf_counter() - start_time
+                    self._record_duration(duration)
+                    result = ''.join(parts) or None
+                    if result:
+                        await asyncio.to_thread(self._cache.set, cache_key, result)
+                    return result
+
+                except openai.APITimeoutError as e:
+                    last_error = e
+                    logger.warning(f"Timeout error (attempt {attempt + 1})")
+                    delay = random.uniform(0, 2 ** attempt)
+
+                except openai.RateLimitError as e:
+                    last_error = e
+                    # Shrink the request budget so the whole pipeline
+                    # slows down, rather than stalling every caller
+                    GPTHelper._rpm = max(60, GPTHelper._rpm // 2)
+                    # Sleep exactly as long as the provider says the
+                    # window needs, not a guessed quantum
+                    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+                    try:
+                        retry_after = float(headers.get("retry-after", 0))
+                    except (TypeError, ValueError):
+                        retry_after = 0.0
+                    delay = (retry_after
+                             or _parse_reset(headers.get("x-ratelimit-reset-requests"))
+                             or random.uniform(0, 2 ** (attempt + 2)))
+                    logger.warning(
+                        f"Rate limit error (attempt {attempt + 1}); retrying in {delay:.1f}s "
+                        f"(budget now {GPTHelper._rpm} rpm)")
+
                 except openai.APIError as e:
+                    last_error = e
                     logger.error(f"OpenAI API Error: {str(e)}")
                     if "model not found" in str(e).lower():
                         logger.error("Invalid model name. Please check your OpenAI API access and model name.")
-                    raise
-                
-            except openai.APITimeoutError:
-                logger.warning(f"Timeout error (attempt {retries + 1})")
-                if retries < self.max_retries:
-                    await asyncio.sleep(2 ** retries)
-                    return await self._call_gpt(content, retries + 1, system_message)
-                raise
-                
-            except openai.RateLimitError:
-                logger.warning(f"Rate limit error (attempt {retries + 1})")
-                await asyncio.sleep(20)
-                if retries < self.max_retries:
-                    return await self._call_gpt(content, retries + 1, system_message)
-                raise
-                
-            except Exception as e:
-                logger.error(f"Error in GPT call: {str(e)}")
-                if retries < self.max_retries:
-                    await asyncio.sleep(2 ** retries)
-                    return await self._call_gpt(content, retries + 1, system_message)
-                return f"Error processing chunk: {str(e)}"
-
-    def _split_into_chunks(self, text: str) -> list[str]:
-        """Split text into processable chunks while preserving markdown structure."""
-        chunks = []
-        current_chunk = []
-        current_size = 0
-        
-        blocks = text.split('\n\n')
-        logger.info(f"Splitting content into chunks (total blocks: {len(blocks)})")
-        
-        for block in blocks:
-            block_size = len(block)
-            
-            if current_size + block_size > self.chunk_size:
-                if current_chunk:
-                    chunks.append('\n\n'.join(current_chunk))
-                current_chunk = [block]
-                current_size = block_size
+                    delay = random.uniform(0, 2 ** attempt)
+
+                except Exception as e:
+                    last_error = e
+                    logger.error(f"Error in GPT call: {str(e)}")
+                    delay = random.uniform(0, 2 ** attempt)
+
+            # Full jitter avoids a thundering herd when many chunks hit
+            # the same provider blip simultaneously; never sleep past the
+            # deadline
+            if attempt < self.max_retries:
+                await asyncio.sleep(min(delay, max(0.0, deadline - loop.time())))
+
+        if isinstance(last_error, (openai.APITimeoutError, openai.RateLimitError)):
+            raise last_error
+        return f"Error processing chunk: {str(last_error)}"
+
+    def _count_tokens(self, text: str) -> int:
+        """Token count as the model sees it."""
+        return len(self._enc.encode_ordinary(text))
+
+    # Fence markers and blank-line boundaries, each found in a single
+    # C-level scan instead of a Python loop over every line
+    _FENCE_RE = re.compile(r'^[ \t]*```', re.M)
+    _BLANK_RE = re.compile(r'\n[ \t]*\n+')
+
+    def _iter_blocks(self, text: str):
+        """Yield logical blocks, keeping fenced code blocks intact.
+
+        Splitting on bare blank lines cuts straight through ``` fences,
+        shipping two broken half-blocks to the model. Fence offsets are
+        collected with one precompiled finditer pass and blocks are
+        sliced straight out of the input, so the hot loop stays in the
+        regex engine rather than walking lines in Python.
+        """
+        fence_positions = [match.start() for match in self._FENCE_RE.finditer(text)]
+
+        pos = 0
+        for match in self._BLANK_RE.finditer(text):
+            # An odd number of fence markers before this blank line means
+            # it sits inside a code block - not a boundary
+            if bisect.bisect_right(fence_positions, match.start()) % 2 == 1:
+                continue
+            block = text[pos:match.start()]
+            if block.strip():
+                yield block.strip('\n')
+            pos = match.end()
+
+        tail = text[pos:]
+        if tail.strip():
+            yield tail.strip('\n')
+
+    def _sub_split(self, block: str, max_tokens: int):
+        """Split one oversized non-fence block into (piece, ntokens) tuples.
+
+        Blocks come out of _iter_blocks with no internal blank lines, so
+        line granularity is the finest natural boundary left.
+        """
+        lines = block.splitlines(keepends=True)
+        line_tokens = [len(t) for t in self._enc.encode_ordinary_batch(lines)]
+
+        pieces = []
+        current: list = []
+        current_tokens = 0
+        for line, ntokens in zip(lines, line_tokens):
+            if current and current_tokens + ntokens > max_tokens:
+                pieces.append((''.join(current).rstrip('\n'), current_tokens))
+                current = []
+                current_tokens = 0
+            current.append(line)
+            current_tokens += ntokens
+        if current:
+            pieces.append((''.join(current).rstrip('\n'), current_tokens))
+        return pieces
+
+    def _split_into_chunks(self, text: str, max_tokens: int = None) -> list[str]:
+        """Split text into processable chunks while preserving markdown structure.
+
+        Chunks are packed by real token count - markdown runs ~3-4
+        characters per token, so character-based packing either wastes
+        2-3x the number of API calls or overshoots the context limit.
+        Fenced code blocks are never split, and headings are preferred
+        as chunk boundaries so chunks align with section starts.
+        """
+        if max_tokens is None:
+            max_tokens = self.chunk_tokens
+
+        blocks = list(self._iter_blocks(text))
+        # encode_ordinary_batch is C-backed and releases the GIL
+        block_tokens = [len(t) for t in self._enc.encode_ordinary_batch(blocks)]
+
+        # A single block can exceed the whole budget (blank-line-free
+        # prose); sub-split those so max_tokens is actually enforced.
+        # Fenced blocks stay whole - never split inside a fence.
+        sized_blocks = []
+        for block, ntokens in zip(blocks, block_tokens):
+            if ntokens > max_tokens and '```' not in block:
+                sized_blocks.extend(self._sub_split(block, max_tokens))
             else:
-                current_chunk.append(block)
-                current_size += block_size
-        
-        if current_chunk:
-            chunks.append('\n\n'.join(current_chunk))
-        
+                sized_blocks.append((block, ntokens))
+
+        # Stream blocks into a single buffer and slice it at recorded
+        # offsets; the old list-of-blocks + join approach re-walked every
+        # string on each flush
+        buf = io.StringIO()
+        starts = [0]
+        current_tokens = 0
+
+        for block, ntokens in sized_blocks:
+            over_budget = current_tokens + ntokens > max_tokens
+            # A heading is a natural section start: flush early rather
+            # than wedging it at the bottom of a nearly-full chunk
+            at_heading = block.startswith('#') and current_tokens >= max_tokens * 0.8
+            if current_tokens > 0 and (over_budget or at_heading):
+                starts.append(buf.tell())
+                current_tokens = 0
+            buf.write(block)
+            buf.write('\n\n')
+            current_tokens += ntokens
+
+        full = buf.getvalue()
+        starts.append(len(full))
+        chunks = [
+            chunk for chunk in
+            (full[starts[i]:starts[i + 1]].rstrip('\n') for i in range(len(starts) - 1))
+            if chunk
+        ]
+
+        # Source docs occasionally contain a stray unpaired ``` marker;
+        # that breaks fence tracking for the rest of the page, so surface
+        # it without failing the whole document
+        for chunk in chunks:
+            if chunk.count('```') % 2 != 0:
+                logger.warning("Chunk has unbalanced code fences (source likely malformed)")
+
         logger.info(f"Created {len(chunks)} chunks")
         return chunks
 
+    _BATCH_SPLIT_RE = re.compile(r'\n?<<<DOC \d+>>>\n?')
+
+    def _ensure_batch_worker(self):
+        """Start the background batching coroutine on first use."""
+        if self._format_queue is None:
+            self._format_queue = asyncio.Queue()
+        if self._batch_worker_task is None or self._batch_worker_task.done():
+            self._batch_worker_task = asyncio.ensure_future(self._batch_worker())
+
+    async def _batch_worker(self):
+        """Drain the format queue, coalescing small documents per API call."""
+        while True:
+            batch: List[Tuple[str, Optional[str], asyncio.Future]] = [await self._format_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(
+                        self._format_queue.get(), timeout=self.batch_window))
+                except asyncio.TimeoutError:
+                    break
+
+            # Only documents that share a system message can share a
+            # call; in practice one prompt dominates a crawl, so groups
+            # are almost always full batches
+            groups: dict = {}
+            for item in batch:
+                groups.setdefault(item[1], []).append(item)
+            for group in groups.values():
+                await self._dispatch_group(group)
+
+    async def _dispatch_group(self, group):
+        """Send one same-prompt group of documents as a single call."""
+        if len(group) == 1:
+            content, system_message, future = group[0]
+            await self._dispatch_single(content, system_message, future)
+            return
+
+        combined = ''.join(
+            f"\n<<<DOC {idx}>>>\n{content}"
+            for idx, (content, _, _) in enumerate(group)
+        )
+        base_message = group[0][1] or _DEFAULT_SYSTEM_MSG
+        try:
+            response = await self._call_gpt(
+                combined, system_message=base_message + _BATCH_WRAPPER_MSG)
+            parts = [p for p in self._BATCH_SPLIT_RE.split(response or '') if p.strip()]
+        except Exception as e:
+            logger.error(f"Batched GPT call failed: {str(e)}")
+            parts = []
+
+        if len(parts) == len(group):
+            for (_, _, future), part in zip(group, parts):
+                if not future.done():
+                    future.set_result(part.strip())
+        else:
+            # Marker structure didn't survive - fall back to one call
+            # per document so nothing gets mis-attributed
+            logger.warning(
+                f"Batch response had {len(parts)} sections for {len(group)} docs; retrying individually")
+            for content, system_message, future in group:
+                await self._dispatch_single(content, system_message, future)
+
+    async def _dispatch_single(self, content: str, system_message: Optional[str], future: asyncio.Future):
+        """Format one document and resolve its waiter."""
+        try:
+            result = await self._call_gpt(content, system_message=system_message)
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+
+    async def _format_batched(self, content: str, system_message: str = None) -> str:
+        """Queue a small document for batched formatting and await it."""
+        self._ensure_batch_worker()
+        future: asyncio.Future = asyncio.get_event_loop().create_future()
+        await self._format_queue.put((content, system_message, future))
+        return await future
+
+    async def iter_formatted(self, content: str, system_message: str = None) -> AsyncIterator[str]:
+        """Yield formatted chunks in document order as they complete.
+
+        A bounded queue feeds a fixed worker pool, so results stream out
+        as ready prefixes instead of waiting for the slowest chunk, and
+        memory stays constant with respect to chunk count. Identical
+        chunks (nav bars, footers, "See Also" boilerplate recur verbatim
+        across crawled docs) are dispatched once and fanned back to
+        every position.
+        """
+        chunks = self._split_into_chunks(content)
+        if not chunks:
+            return
+
+        # Content-addressed dedupe: order holds the document sequence,
+        # unique maps digest -> chunk for the chunks actually dispatched
+        order: List[bytes] = []
+        unique: dict = {}
+        for chunk in chunks:
+            digest = hashlib.blake2b(chunk.encode(), digest_size=16).digest()
+            order.append(digest)
+            unique.setdefault(digest, chunk)
+        if len(unique) < len(chunks):
+            logger.info(f"Deduplicated {len(chunks) - len(unique)} of {len(chunks)} chunks")
+
+        in_queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_concurrent_calls * 2)
+        out_queue: asyncio.Queue = asyncio.Queue()
+        n_workers = min(self.max_concurrent_calls, len(unique))
+
+        async def producer():
+            for digest, chunk in unique.items():
+                await in_queue.put((digest, chunk))
+            for _ in range(n_workers):
+                await in_queue.put(None)
+
+        async def worker():
+            while True:
+                item = await in_queue.get()
+                if item is None:
+                    break
+                digest, chunk = item
+                try:
+                    result = await self._call_gpt(chunk, system_message=system_message)
+                except Exception as e:
+                    logger.error(f"Error formatting chunk: {str(e)}")
+                    result = None
+                await out_queue.put((digest, result))
+
+        producer_task = asyncio.ensure_future(producer())
+        workers = [asyncio.ensure_future(worker()) for _ in range(n_workers)]
+
+        results: dict = {}
+        next_idx = 0
+        received = 0
+        try:
+            while received < len(unique):
+                digest, result = await out_queue.get()
+                received += 1
+                results[digest] = result
+                # Emit the ready prefix in document order
+                while next_idx < len(order) and order[next_idx] in results:
+                    ready = results[order[next_idx]]
+                    next_idx += 1
+                    if ready:
+                        yield ready
+        finally:
+            producer_task.cancel()
+            for worker_task in workers:
+                worker_task.cancel()
+
     async def format_documentation(self, content: str) -> str:
         """Process documentation chunks in parallel and combine results."""
         try:
             start_time = perf_counter()
             logger.info("Starting documentation formatting")
-            chunks = self._split_into_chunks(content)
-            
-            # Process all chunks in parallel
-            tasks = [self._call_gpt(chunk) for chunk in chunks]
-            formatted_chunks = await asyncio.gather(*tasks)
-            formatted_chunks = [chunk for chunk in formatted_chunks if chunk]
-            
+
+            # Documents that fit in a batch slot go through the batching
+            # queue so several pages share one API round-trip
+            if self._count_tokens(content) <= self.batch_doc_tokens:
+                return await self._format_batched(content)
+
             logger.info("Combining chunks")
-            combined = '\n\n---\n\n'.join(formatted_chunks)
-            
+            separator_needed = False
+            buf = io.StringIO()
+            async for formatted in self.iter_formatted(content):
+                if separator_needed:
+                    buf.write('\n\n---\n\n')
+                buf.write(formatted)
+                separator_needed = True
+            combined = buf.getvalue()
+
             end_time = perf_counter()
             total_duration = end_time - start_time
-            logger.info(f"Documentation formatting completed - Total time: {total_duration:.2f}s, API calls: {self.total_api_calls}, Avg API time: {self.total_api_time/self.total_api_calls:.2f}s")
+            logger.info(f"Documentation formatting completed - Total time: {total_duration:.2f}s, API calls so far: {self._call_count}")
             return combined
-            
+
         except Exception as e:
             logger.error(f"Error in format_documentation: {str(e)}")
             return f"Error formatting documentation: {str(e)}"
 
-    async def final_review(self, content: str) -> str:
-        """Perform a final review of the entire documentation."""
+    async def format_and_review(self, content: str) -> str:
+        """Format and review a document in one fused pass per chunk.
+
+        Running the formatter and reviewer prompts as a single call does
+        both jobs for one round-trip, halving API calls and token spend
+        versus the two-phase format_documentation + review_section path
+        (which remains available).
+        """
+        try:
+            start_time = perf_counter()
+            logger.info("Starting fused formatting and review")
+
+            # Small documents share one API round-trip via the batch
+            # queue, same as the plain formatting path
+            if self._count_tokens(content) <= self.batch_doc_tokens:
+                return await self._format_batched(content, system_message=_FUSED_SYSTEM_MSG) or ''
+
+            separator_needed = False
+            buf = io.StringIO()
+            async for formatted in self.iter_formatted(content, system_message=_FUSED_SYSTEM_MSG):
+                if separator_needed:
+                    buf.write('\n\n---\n\n')
+                buf.write(formatted)
+                separator_needed = True
+
+            total_duration = perf_counter() - start_time
+            logger.info(f"Fused formatting completed - Total time: {total_duration:.2f}s")
+            return buf.getvalue()
+
+        except Exception as e:
+            logger.error(f"Error in format_and_review: {str(e)}")
+            return f"Error formatting documentation: {str(e)}"
+
+    async def review_section(self, url: str, content: str) -> str:
+        """Review a single documentation section, keeping it self-contained."""
+        logger.info(f"Reviewing section for: {url}")
+        result = await self._call_gpt(
+            content, system_message=_SECTION_REVIEW_SYSTEM_MSG)
+        return result or content
+
+    async def stitch(self, section_names: List[str]) -> str:
+        """Produce a short introduction and table of contents for the document."""
+        logger.info("Stitching document intro and table of contents")
+        listing = '\n'.join(f"- {name}" for name in section_names)
+        result = await self._call_gpt(
+            listing, system_message=_STITCH_SYSTEM_MSG)
+        return result or ''
+
+    async def _stream_gpt_to_file(self, content: str, system_message: str, output_path: str) -> str:
+        """Make a streaming GPT call, writing tokens to disk as they arrive.
+
+        Overlaps generation with the disk write, so by the time the model
+        finishes the file is already on disk.
+        """
+        async with self._semaphore:
+            logger.info(f"Streaming GPT response to: {output_path}")
+            stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": system_message},
+                    {"role": "user", "content": content}
+                ],
+                temperature=0.1,
+                stream=True
+            )
+            parts = []
+            async with aiofiles.open(output_path, 'w', encoding='utf-8') as f:
+                async for event in stream:
+                    if not event.choices:
+                        continue
+                    delta = event.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        await f.write(delta)
+            return ''.join(parts)
+
+    async def final_review(self, content: str, output_path: Optional[str] = None) -> str:
+        """Perform a final review of the entire documentation.
+
+        Chunks are reviewed in parallel and then merged pairwise in
+        layers, so no single call ever sees more than about two chunks
+        of input. When output_path is given, the final document is also
+        written there.
+        """
         try:
             logger.info("Starting final documentation review")
             start_time = perf_counter()
 
-            # Split into larger chunks for final review since we're just cleaning up
-            original_chunk_size = self.chunk_size
-            self.chunk_size = 4000  # Temporarily increase chunk size
-            chunks = self._split_into_chunks(content)
-            self.chunk_size = original_chunk_size
+            # Larger chunks for final review since we're just cleaning up
+            chunks = self._split_into_chunks(content, max_tokens=self.review_chunk_tokens)
 
-            review_tasks = []
+            # Review each distinct chunk once and fan results back
+            order = []
+            unique = {}
             for chunk in chunks:
-                task = self._call_gpt(
-                    chunk,
-                    system_message="""You are an expert technical documentation reviewer. Review and improve this API documentation chunk.
-Focus on:
-1. Removing any duplicate content
-2. Ensuring consistent formatting and style
-3. Making the documentation clear and readable
-4. Proper markdown formatting
-5. Consistent heading hierarchy
-6. Proper section breaks
-7. Complete and accurate endpoint documentation
-8. Consistent use of code blocks and tables
-9. Clear parameter descriptions
-10. Proper grouping of related endpoints
-
-Keep all valid API endpoint information but make it more concise and well-organized."""
-                )
-                review_tasks.append(task)
+                digest = hashlib.blake2b(chunk.encode(), digest_size=16).digest()
+                order.append(digest)
+                unique.setdefault(digest, chunk)
 
-            # Process review chunks in parallel
-            reviewed_chunks = await asyncio.gather(*review_tasks)
-            reviewed_chunks = [chunk for chunk in reviewed_chunks if chunk]
+            review_tasks = [
+                self._call_gpt(chunk, system_message=_REVIEW_SYSTEM_MSG)
+                for chunk in unique.values()
+            ]
+            results = dict(zip(unique.keys(), await asyncio.gather(*review_tasks)))
+            reviewed_chunks = [results[digest] for digest in order if results[digest]]
             
             # Combine reviewed chunks
             logger.info("Combining reviewed chunks")
             combined = '\n\n'.join(reviewed_chunks)
 
-            # Final pass to ensure consistency across the entire document
-            logger.info("Making final consistency pass")
-            final_content = await self._call_gpt(
-                combined,
-                system_message="""You are an expert technical documentation editor. This is the final pass of the API documentation.
-Your task is to ensure the entire document is consistent and well-organized.
+            # Merge adjacent chunks in parallel layers instead of one
+            # monolithic consistency call: every request stays bounded by
+            # ~two chunks of input, layers run concurrently, and large
+            # documents can no longer overflow the model context
+            max_layers = 8  # safety bound; each layer halves the chunk count
+            streamed = False
+            for _ in range(max_layers):
+                if len(reviewed_chunks) <= 1:
+                    break
+                if len(reviewed_chunks) == 2 and output_path is not None:
+                    # Stream the last merge straight to the output file so
+                    # the disk write overlaps generation
+                    merged_last = await self._stream_gpt_to_file(
+                        '\n\n'.join(reviewed_chunks), _MERGE_SYSTEM_MSG, output_path)
+                    if merged_last:
+                        reviewed_chunks = [merged_last]
+                        streamed = True
+                        break
+                logger.info(f"Merging {len(reviewed_chunks)} reviewed chunks pairwise")
+                pairs = [reviewed_chunks[i:i + 2] for i in range(0, len(reviewed_chunks), 2)]
+                merge_tasks = [
+                    self._call_gpt('\n\n'.join(pair), system_message=_MERGE_SYSTEM_MSG)
+                    if len(pair) == 2 else asyncio.sleep(0, result=pair[0])
+                    for pair in pairs
+                ]
+                merged = [chunk for chunk in await asyncio.gather(*merge_tasks) if chunk]
 
-Focus on:
-1. Consistent structure throughout the document
-2. Clear and logical organization of endpoints
-3. Proper table of contents
-4. Consistent heading levels
-5. Remove any remaining duplicates
-6. Ensure all cross-references are valid
-7. Consistent formatting of endpoints, parameters, and examples
-8. Group related endpoints together
-9. Add clear section dividers
-10. Ensure all API information is accurate and complete
-
-Maintain all API endpoint information but make it as clear and well-organized as possible."""
-            )
+                # Re-split any merge that came back oversized so the next
+                # layer's inputs stay bounded
+                reviewed_chunks = []
+                for chunk in merged:
+                    if self._count_tokens(chunk) > self.review_chunk_tokens:
+                        reviewed_chunks.extend(self._split_into_chunks(chunk))
+                    else:
+                        reviewed_chunks.append(chunk)
+
+            # If the layer budget ran out with chunks still unmerged,
+            # keep them all rather than silently dropping the tail
+            if len(reviewed_chunks) > 1:
+                logger.warning(
+                    f"Merge layers exhausted with {len(reviewed_chunks)} chunks left; concatenating")
+                final_content = '\n\n'.join(reviewed_chunks)
+            else:
+                final_content = reviewed_chunks[0] if reviewed_chunks else None
+            if final_content and output_path is not None and not streamed:
+                async with aiofiles.open(output_path, 'w', encoding='utf-8') as f:
+                    await f.write(final_content)
 
             end_time = perf_counter()
             total_duration = end_time - start_time
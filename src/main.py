@@ -1,4 +1,5 @@
 from doc_crawler import DocCrawler
+from gpt_helper import GPTHelper
 import asyncio
 import argparse
 
@@ -11,14 +12,15 @@ async def main():
     
     args = parser.parse_args()
 
-    crawler = DocCrawler(
+    gpt_helper = GPTHelper()
+    async with DocCrawler(
         base_url=args.url,
         output_dir=args.output,
         max_pages=args.max_pages,
-        max_concurrent_pages=args.concurrent
-    )
-
-    await crawler.crawl()
+        max_concurrent_pages=args.concurrent,
+        gpt_helper=gpt_helper
+    ) as crawler:
+        await crawler.crawl()
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file